@@ -3,8 +3,13 @@ Perform some basic analysis on the REs given.
 """
 
 import re
+import time
+import itertools
 import reg
 import nfa
+import deriv
+import bounded
+from domain import domain
 
 class Impossible(Exception):
   pass
@@ -18,17 +23,223 @@ def alphabet(res):
   """
   return set([ c for re in res for c in re if c.isupper() ]).union('_')
 
-def pattern(s):
+def pattern(s, derivatives = False):
   if s.find("\\") >= 0:
     return NativePattern(s)
+  if derivatives:
+    return DerivPattern(s)
   return FAPattern(s)
 
+FORWARD = 0
+REVERSE = 1
+
+class Trace(object):
+  """
+  The record of one directional pass of wash over a line: the character
+  sets that went in, the state set in force before each position (and
+  after the last), and the character sets that survived.
+  """
+
+  __slots__ = ('inputs', 'states', 'outputs')
+
+  def __init__(self, states, inputs):
+    self.inputs = list(inputs)
+    self.states = [ states ]
+    self.outputs = []
+
+def _same(a, b):
+  return a is b or a == b
+
+
+class Compiled(object):
+  """
+  The part of a pattern that doesn't depend on the line it constrains:
+  the automata, the matcher, and per-length caches of squeeze results.
+  Lines (and puzzles) whose expressions are equivalent share a single
+  Compiled, through compile().
+  """
+
+  # The most squeeze results kept for any one line length.
+  CACHE = 10000
+
+  # The most subset DFA states kept. A run that goes past this finishes;
+  # the next starts the DFA again.
+  SUBSETS = 10000
+
+  def __init__(self, s, parsed):
+    self.re = parsed
+    # The automata are built by compile(), when a pattern first needs
+    # them: the Thompson NFA for FAPattern and NativePattern, and the DFA
+    # of derivatives for DerivPattern.
+    self.nfa = None
+    self.dfa = None
+    self._squeezed = {}
+
+    # The DFA that match() and batch() run on, built from the NFA by
+    # subset construction as its transitions are needed (see _begin).
+    self._start = None
+
+    try:
+      self.matcher = re.compile("^" + s + "$")
+    except:
+      print "Using our own implementation of the matcher"
+      self.matcher = self  # We'll supply the match implementation
+
+  def _begin(self):
+    """
+    Start the subset DFA afresh. DFA states are numbered; _members holds
+    the set of NFA states for each.
+    """
+    self._subsets = {}
+    self._members = []
+    self._accepting = []
+    self._trans = {}
+    fa = self.nfa
+    self._start = self._subset(fa.epsilon_closure([ fa.start ]))
+    self._dead = self._subset(frozenset())
+
+  def squeezed(self, n):
+    cache = self._squeezed.get(n)
+    if cache is None or len(cache) >= self.CACHE:
+      cache = self._squeezed[n] = {}
+    return cache
+
+  def _subset(self, states):
+    n = self._subsets.get(states)
+    if n is None:
+      n = self._subsets[states] = len(self._members)
+      self._members.append(states)
+      self._accepting.append(self.nfa.end in states)
+    return n
+
+  def _follow(self, n, char):
+    d = self._trans.get((n, char))
+    if d is None:
+      fa = self.nfa
+      new = set()
+      for s in self._members[n]:
+        new.update(fa.advance(s, char))
+      d = self._trans[n, char] = self._subset(frozenset(new))
+    return d
+
+  def _fresh(self):
+    if self._start is None or len(self._members) > self.SUBSETS:
+      self._begin()
+
+  def match(self, string):
+    self._fresh()
+    n = self._start
+    for char in string:
+      n = self._follow(n, char)
+      if n == self._dead:
+        return False
+    # Matched, are we at an accepting state?
+    return self._accepting[n]
+
+  def batch(self, columns):
+    """
+    Run a block of candidate strings through the DFA together, a
+    position at a time: columns[k][j] is the character at position k of
+    the j'th candidate (so each column can be a string, a tuple or a
+    list). Returns the set of characters at each position among the
+    candidates that are accepted.
+    """
+    if not columns:
+      return []
+    self._fresh()
+    trans = self._trans
+    states = [ self._start ] * len(columns[0])
+    for column in columns:
+      keys = zip(states, column)
+      states = map(trans.get, keys)
+      if None in states:
+        states = [ self._follow(*k) if n is None else n for n, k in zip(states, keys) ]
+    accepting = self._accepting
+    accepted = [ j for j, n in enumerate(states) if accepting[n] ]
+    return [ set(column[j] for j in accepted) for column in columns ]
+
+
+# The most entries kept in each of _compiled and _parsed.
+TABLE = 5000
+
+# Compiled patterns by text, normal form and language (see compile).
+_compiled = bounded.LRU(TABLE)
+
+# Expressions whose minimal DFAs would have more states than this, or
+# whose normalised text is longer than EQUIVALENCE_SIZE, are not
+# checked for equivalence with others.
+EQUIVALENCE_LIMIT = 1000
+EQUIVALENCE_SIZE = 1000
+
+def compile(s, derivatives = False):
+  """
+  Return the shared Compiled for an expression over the current
+  alphabet. It's looked up by the text as given; then, for expressions
+  without back-references, by the text of the normalised RE and by the
+  language it accepts (as the signature of its minimal DFA). It comes
+  with its NFA built, or with its DFA of derivatives if derivatives is
+  set.
+  """
+  alphabet = frozenset(reg._alphabet)
+  key = ("text", s, alphabet)
+  c = _compiled.get(key)
+  if c is None:
+    c = _compiled[key] = _compile(s, alphabet)
+  if derivatives:
+    if c.dfa is None:
+      c.dfa = deriv.DFA(c.re, alphabet)
+  elif c.nfa is None:
+    c.nfa = nfa.NFA(c.re).simplify().compact()
+  return c
+
+def _compile(s, alphabet):
+  if s.find("\\") >= 0:
+    return Compiled(s, reg.normalise(reg.parse(reg.approximate(s))))
+
+  parsed = reg.normalise(reg.parse(s))
+  normal = str(parsed)
+  keys = [ ("normal", normal, alphabet) ]
+  dfa = None
+  if len(normal) <= EQUIVALENCE_SIZE:
+    dfa = deriv.DFA(parsed, alphabet)
+    signature = dfa.signature(EQUIVALENCE_LIMIT)
+    if signature is not None:
+      keys.append(("language", signature, alphabet))
+
+  for key in keys:
+    if key in _compiled:
+      c = _compiled[key]
+      break
+  else:
+    c = Compiled(s, parsed)
+    c.dfa = dfa
+  for key in keys:
+    _compiled.setdefault(key, c)
+  return c
+
+# Parsed expressions by text and alphabet, so that a puzzle built again
+# (say, by a long-running server) doesn't have to parse them again.
+_parsed = bounded.LRU(TABLE)
+
+def parse(s):
+  key = (s, frozenset(reg._alphabet))
+  r = _parsed.get(key)
+  if r is None:
+    r = _parsed[key] = reg.parse(s)
+  return r
+
 class Pattern(object):
   """
   A constraint object. This holds onto the original RE,
   the compiled RE (if it was compilable), the corresponding
   state machine (again, as appopriate) and provides an
   implementation of wash, squeeze and exhaust.
+
+  Patterns are per-line: each keeps the Trace of its last forward and
+  reverse passes, so that re-washing a line after a few of its cells
+  have narrowed only redoes the part of each pass that could change.
+  The automaton and matcher belong to a Compiled shared between all
+  equivalent patterns.
   """
 
   def wash(self, poss):
@@ -38,79 +249,118 @@ class Pattern(object):
       # Forward pass...
       #print "WASHING forward"
       #print "  before:", self._dump_poss(poss)
-      poss, _ = self._wash(poss,
-                        self._nfa.start,
-                        lambda s: nfa.epsilon_closure(s),
-                        lambda c, s: s.outs(c))
+      poss = self._pass(poss, FORWARD).outputs[:]
       #print "  after:", self._dump_poss(poss)
       # ...and reverse
       #print "WASHING reverse"
-      poss.reverse()
-      poss, _ = self._wash(poss,
-                        self._nfa.end,
-                        lambda s: nfa.epsilon_closure_reverse(s),
-                        lambda c, s: s.ins(c))
-      poss.reverse()
+      poss = self._pass(poss[::-1], REVERSE).outputs[::-1]
       #print "  after:", self._dump_poss(poss)
     return poss
 
   def _dump_poss(self, poss):
     return ''.join(map( lambda s: '[' + ''.join(sorted(s)) + ']', poss))
 
-  def _wash(self, poss, begin, close, advance):
-    #print "WASHING"
-    states = close(set([ begin ]))
-    poss2 = []
-    for char_set in poss:
+  def _pass(self, poss, direction):
+    """
+    Run one directional pass of wash over poss (given in the order the
+    pass reads it), returning its Trace.
+
+    The trace of the previous pass in the same direction is kept. The
+    work before the first position whose character set has changed is
+    reused; and once the state set after the last changed position is
+    the same as last time, so is everything that follows.
+    """
+    fa = self._nfa
+    # The trace holds on to the sets it was given, so they had better be
+    # ones that can't be changed under it.
+    poss = map(domain, poss)
+    old = self._traces.get(direction)
+    n = len(poss)
+    if old is None or len(old.inputs) != n:
+      if direction == FORWARD:
+        begin = fa.epsilon_closure([ fa.start ])
+      else:
+        begin = fa.epsilon_closure_reverse([ fa.end ])
+      old = Trace(begin, [ None ] * n)
+
+    first = 0
+    while first < n and _same(poss[first], old.inputs[first]):
+      first += 1
+    if first == n:
+      return old
+    last = n - 1
+    while _same(poss[last], old.inputs[last]):
+      last -= 1
+
+    advance = fa.advance if direction == FORWARD else fa.retreat
+    trace = Trace(old.states[first], poss)
+    trace.states[:0] = old.states[:first]
+    trace.outputs = old.outputs[:first]
+    states = trace.states[-1]
+    for i in range(first, n):
+      if i > last and states == old.states[i]:
+        # We've fallen back into step with the previous pass.
+        trace.states += old.states[i + 1:]
+        trace.outputs += old.outputs[i:]
+        break
+
+      char_set = poss[i]
       #print "  Wash, char set =", ''.join(sorted(char_set))
-      #print "  Current states =", ','.join(map(str, sorted(map(lambda s: s.label, states))))
+      #print "  Current states =", ','.join(map(str, sorted(states)))
       new_char_set = set()
       new_states = set()
       for char in char_set:
         for state in states:
-          outs = close(advance(char, state))
+          outs = advance(state, char)
           if outs:
-            #print '    Viable transition on', char, ' to ', map(lambda s: s.label, outs)
+            #print '    Viable transition on', char, ' to ', sorted(outs)
             new_char_set.add(char)
             new_states.update(outs)
       if not new_states:
-        raise Impossible("wash has run out of state possibilities", len(poss), len(poss2), states, poss, poss2)
+        raise Impossible("wash has run out of state possibilities", n, i, states, poss)
       states = new_states
       if not new_char_set:
         raise Impossible("wash has run out of character possibilities")
-      poss2.append(new_char_set)
-    return poss2, states
+      trace.states.append(states)
+      trace.outputs.append(domain(new_char_set))
+
+    self._traces[direction] = trace
+    return trace
 
   def squeeze(self, poss):
-    change = True
-    while change:
-      #print "SQUEEZE LOOP"
-      change = False
-      for k in range(len(poss)):
-        poss, c = self._squeeze(poss, k)
-        change = change or c
-    return poss
+    cache = self._compiled.squeezed(len(poss))
+    key = tuple(map(domain, poss))
+    res = cache.get(key)
+    if res is None:
+      poss = list(poss)
+      try:
+        change = True
+        while change:
+          #print "SQUEEZE LOOP"
+          change = False
+          for k in range(len(poss)):
+            poss, c = self._squeeze(poss, k)
+            change = change or c
+        res = tuple(poss)
+      except Impossible as e:
+        res = e
+      cache[key] = res
+    if isinstance(res, Impossible):
+      raise res
+    return list(res)
 
   def _squeeze(self, poss, k):
     #print "  squeezing", k
-    _, precursors = self._wash(poss[:k],
-                        self._nfa.start,
-                        lambda s: nfa.epsilon_closure(s),
-                        lambda c, s: s.outs(c))
-
-    poss.reverse()
-    _, postcursors = self._wash(poss[:len(poss) - k - 1],
-                        self._nfa.end,
-                        lambda s: nfa.epsilon_closure_reverse(s),
-                        lambda c, s: s.ins(c))
-    poss.reverse()
+    fa = self._nfa
+    precursors = self._pass(poss, FORWARD).states[k]
+    postcursors = self._pass(poss[::-1], REVERSE).states[len(poss) - k - 1]
 
     # Locate possible transitions from s1 in precursors to s2 in postcursors.
     trans = set()
     change = False
     for char in poss[k]:
       for s1 in precursors:
-        if s1.outs(char).intersection(postcursors):
+        if not postcursors.isdisjoint(fa.advance(s1, char)):
           trans.add(char)
           break
       else:
@@ -118,16 +368,66 @@ class Pattern(object):
 
     if not trans:
       raise Impossible("squeeze has run out of possibilities", poss, k, precursors, postcursors)
-    poss[k] = trans
+    poss[k] = domain(trans)
     return poss, change
 
-  def exhaust(self, constraints):
+  exact = True
+
+  def accepts(self, string):
+    return bool(self._matcher.match(string))
+
+  # Candidates are generated, and checked, in blocks of this many.
+  BATCH = 4096
+
+  def exhaust(self, constraints, budget = None):
+    """
+    Try every candidate string against the real expression. Given a
+    budget, stop when it runs out and return only what has been proved:
+    candidates are tried a first character at a time, so a first
+    character all of whose candidates failed can be ruled out, and
+    everything else is left as it was.
+    """
     #print "Attempting to exhaust possibilities"
+    if not constraints:
+      return []
+    if budget is None:
+      budget = Budget()
     possible = [ set() for i in constraints ]
-    for p in possibilities(constraints):
-      if self._matcher.match(p):
-        _update(possible, p)
-    return possible
+    budget.begin(candidates(constraints))
+    done = set()
+    for first in sorted(constraints[0]):
+      rest = itertools.product(*constraints[1:])
+      while not budget.expired:
+        block = list(itertools.islice(rest, self.BATCH))
+        if not block:
+          done.add(first)
+          break
+        block = block[:budget.spend(len(block))]
+        if block:
+          self._verify(first, block, possible)
+      if budget.expired:
+        break
+    budget.end()
+    if budget.expired:
+      possible = ([ set(c for c in constraints[0] if c not in done or c in possible[0]) ] +
+                  list(constraints[1:]))
+    return map(domain, possible)
+
+  def _verify(self, first, block, possible):
+    """
+    Add the characters of those candidates (first followed by each of
+    block) that match to possible.
+    """
+    batch = getattr(self._matcher, "batch", None)
+    if batch is not None:
+      found = batch([ first * len(block) ] + zip(*block))
+      for k in range(len(possible)):
+        possible[k].update(found[k])
+    else:
+      for rest in block:
+        p = first + "".join(rest)
+        if self._matcher.match(p):
+          _update(possible, p)
 
 
 def _update(constraints, string):
@@ -136,21 +436,138 @@ def _update(constraints, string):
     constraints[i].add(string[i])
 
 
-def possibilities(constraints):
-  if constraints == []:
-    yield ""
-  else:
-    for p in constraints[0]:
-      for ps in possibilities(constraints[1:]):
-        yield p + ps
+def candidates(constraints):
+  """
+  How many strings exhaust would have to try.
+  """
+  n = 1
+  for c in constraints:
+    n *= len(c)
+  return n
+
+
+class Budget(object):
+  """
+  A limit on the work one exhaust may do: a number of candidates
+  (ops), a number of seconds, or both. Afterwards it records how the
+  run went - how many candidates were tried, in how long, whether the
+  budget expired and how many candidates were left untried - and
+  estimate() gives the time those would have taken.
+  """
+
+  # How many candidates to try between looks at the clock.
+  CHECK = 256
+
+  def __init__(self, ops = None, seconds = None):
+    self.ops = ops
+    self.seconds = seconds
+    self.total = 0
+    self.tried = 0
+    self.elapsed = 0.0
+    self.expired = False
+    self.remaining = 0
+
+  def begin(self, total):
+    self.total = total
+    self.tried = 0
+    self.expired = False
+    self._check = 0
+    self._start = time.time()
+
+  def spend(self, n = 1):
+    """
+    Account for up to n more candidates, returning how many of them
+    can be tried within the budget.
+    """
+    wanted = n
+    if self.ops is not None:
+      n = min(n, self.ops - self.tried)
+    if n > 0 and self.seconds is not None and self.tried >= self._check:
+      self._check = self.tried + self.CHECK
+      if time.time() - self._start >= self.seconds:
+        n = 0
+    if n < wanted:
+      self.expired = True
+    if n <= 0:
+      return 0
+    self.tried += n
+    return n
+
+  def end(self):
+    self.elapsed = time.time() - self._start
+    self.remaining = self.total - self.tried
+    throughput.update(self)
+
+  def rate(self):
+    """
+    Candidates per second, or None if it was too quick to tell.
+    """
+    if self.elapsed <= 0:
+      return None
+    return self.tried / self.elapsed
+
+  def estimate(self):
+    """
+    Seconds needed to try the remaining candidates at the same rate.
+    """
+    r = self.rate()
+    if not r:
+      return None
+    return self.remaining / r
+
+  def __str__(self):
+    s = "%d of %d candidates in %.2fs" % (self.tried, self.total, self.elapsed)
+    if self.expired:
+      e = self.estimate()
+      s += ", out of budget with %d left" % self.remaining
+      if e is not None:
+        s += " (about %.1fs)" % e
+    return s
+
+
+class Throughput(object):
+  """
+  A running estimate of the candidates per second that exhaust gets
+  through, fed by every budgeted run, so that thresholds can be set as
+  a time rather than a fixed number of candidates.
+  """
+
+  # Candidates per second to assume before anything has been measured.
+  DEFAULT = 100000
+
+  def __init__(self):
+    self.rate = None
+
+  def update(self, budget):
+    if budget.tried < Budget.CHECK:
+      return  # Too little to go by
+    r = budget.rate()
+    if r:
+      self.rate = r if self.rate is None else (self.rate + r) / 2.0
+
+  def candidates(self, seconds):
+    """
+    How many candidates we expect exhaust to try in the given time.
+    """
+    return int((self.rate or self.DEFAULT) * seconds)
+
+  def seconds(self, candidates):
+    return candidates / float(self.rate or self.DEFAULT)
+
+throughput = Throughput()
 
 
 class NativePattern(Pattern):
+  # The automaton only approximates an expression with back-references.
+  exact = False
+
   def __init__(self, s):
     self.string = s
-    self._re = reg.parse(reg.approximate(s))
-    self._nfa = nfa.NFA(self._re)
-    self._matcher = re.compile("^" + s + "$")
+    self._re = parse(reg.approximate(s))
+    self._compiled = compile(s)
+    self._nfa = self._compiled.nfa
+    self._matcher = self._compiled.matcher
+    self._traces = {}
 
   def __str__(self):
     return self.string
@@ -159,29 +576,73 @@ class NativePattern(Pattern):
 class FAPattern(Pattern):
   def __init__(self, s):
     self.string = s
-    self._re = reg.parse(s)
-    self._nfa = nfa.NFA(self._re)
-
-    try:
-      self._matcher = re.compile("^" + s + "$")
-    except:
-      print "Using our own implementation of the matcher"
-      self._matcher = self  # We'll supply the match implementation
+    self._re = parse(s)
+    self._compiled = compile(s)
+    self._nfa = self._compiled.nfa
+    self._matcher = self._compiled.matcher
+    self._traces = {}
 
   def __str__(self):
     return str(self._re)
 
   def match(self, string):
-    states = nfa.epsilon_closure(set([ self._nfa.start ]))
-    for char in string:
-      new = set()
-      for s in states:
-        new.update(nfa.epsilon_closure(s.outs(char)))
-      states = new
+    return self._compiled.match(string)
+
+class DerivPattern(Pattern):
+  """
+  A constraint whose automaton is the DFA of derivatives of the RE,
+  rather than a Thompson NFA. Because each position has a set of DFA
+  states reached by the forward pass, a single backward sweep over those
+  sets leaves exactly the characters that lie on an accepting path; so
+  here wash is already as strong as squeeze.
+  """
+
+  def __init__(self, s):
+    self.string = s
+    self._re = parse(s)
+    self._compiled = compile(s, derivatives = True)
+    self._dfa = self._compiled.dfa
+    self._matcher = self._compiled.matcher
+    if self._matcher is self._compiled:
+      self._matcher = self._dfa  # Rather than build the NFA as well
+
+  def __str__(self):
+    return str(self._re)
+
+  def wash(self, poss):
+    dfa = self._dfa
+    # Forward: the live states in force before each position.
+    forward = [ set([ dfa.start ]) ]
+    for char_set in poss:
+      states = set()
+      for state in forward[-1]:
+        for char in char_set:
+          d = dfa.step(state, char)
+          if d is not dfa.dead:
+            states.add(d)
       if not states:
-        return False
-    # Matched, are we at an accepting state?
-    for s in states:
-      if s.end:
-        return True
-    return False
+        raise Impossible("wash has run out of state possibilities", poss)
+      forward.append(states)
+
+    # Backward: keep only transitions that lead to acceptance.
+    live = set([ s for s in forward[-1] if dfa.accepting(s) ])
+    poss2 = [ None ] * len(poss)
+    for k in reversed(range(len(poss))):
+      new_char_set = set()
+      new_live = set()
+      for state in forward[k]:
+        for char in poss[k]:
+          if dfa.step(state, char) in live:
+            new_char_set.add(char)
+            new_live.add(state)
+      if not new_char_set:
+        raise Impossible("wash has run out of character possibilities", poss, k)
+      poss2[k] = domain(new_char_set)
+      live = new_live
+    return poss2
+
+  def squeeze(self, poss):
+    return self.wash(poss)
+
+  def match(self, string):
+    return self._dfa.match(string)
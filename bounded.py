@@ -0,0 +1,65 @@
+"""
+Tables with a limit on their size, for the caches and interning tables
+that a long-running solver (see server.py) would otherwise grow for as
+long as it lives.
+"""
+
+import collections
+
+
+class LRU(object):
+  """
+  A cache that holds at most size entries: storing another once it's
+  full drops the entry that was least recently looked up or stored.
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self._entries = collections.OrderedDict()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key, default = None):
+    entries = self._entries
+    if key not in entries:
+      return default
+    value = entries[key] = entries.pop(key)  # Now the most recent
+    return value
+
+  def __getitem__(self, key):
+    entries = self._entries
+    value = entries[key] = entries.pop(key)
+    return value
+
+  def __setitem__(self, key, value):
+    entries = self._entries
+    if key in entries:
+      del entries[key]
+    elif len(entries) >= self.size:
+      entries.popitem(last = False)
+    entries[key] = value
+
+  def setdefault(self, key, value):
+    if key in self._entries:
+      return self[key]
+    self[key] = value
+    return value
+
+  def clear(self):
+    self._entries.clear()
+
+
+def room(table, size):
+  """
+  Make room for another entry in a table that holds at most size, by
+  starting it again once it's full. This is for interning tables, whose
+  entries are shared on the understanding that equal ones are identical:
+  dropping just a few of them would break that for the ones in use, where
+  dropping them all can be done between uses.
+  """
+  if len(table) >= size:
+    table.clear()
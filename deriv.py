@@ -0,0 +1,267 @@
+"""
+A Brzozowski-derivative library.
+
+Rather than building a Thompson NFA, we work on the RE tree itself.
+The derivative of an RE with respect to a character c is an RE that
+matches w exactly when the original matches cw. Taking derivatives of
+derivatives gives a DFA whose states are REs; provided those REs are
+kept in a normal form (alternation is associative, commutative and
+idempotent), there are only finitely many of them.
+
+Nodes are hash-consed through a Table, so structurally equal REs are
+the same object and each derivative is computed once and memoised on
+the node. The canonical forms used are:
+
+  - the empty language is the empty class, REClass(())
+  - the empty string is the empty concatenation, REConc()
+  - single characters, classes and . are all held as character sets
+  - REGroup, REPlus and REOpt are rewritten in terms of the others
+"""
+
+import reg
+import bounded
+
+
+class Table(object):
+  """
+  A hash-consing table of normalised RE nodes over a single alphabet.
+  """
+
+  def __init__(self, alphabet):
+    self.alphabet = frozenset(alphabet)
+    self._nodes = {}
+    self.empty = self.chars(())
+    self.epsilon = self._intern((".",), lambda: reg.REConc(), True)
+
+  def _intern(self, key, make, nullable, chars = None):
+    node = self._nodes.get(key)
+    if node is None:
+      node = make()
+      node._serial = len(self._nodes)
+      node._nullable = nullable
+      node._chars = chars
+      node._derivs = {}
+      self._nodes[key] = node
+    return node
+
+  def __len__(self):
+    return len(self._nodes)
+
+  def chars(self, cs):
+    cs = frozenset(cs).intersection(self.alphabet)
+    def make():
+      if len(cs) == 1:
+        return reg.REChar(next(iter(cs)))
+      if cs == self.alphabet:
+        return reg.REAny()
+      return reg.REClass(cs)
+    return self._intern(("[]", cs), make, False, cs)
+
+  def conc(self, *nodes):
+    res = []
+    for n in nodes:
+      if n is self.empty:
+        return self.empty
+      if isinstance(n, reg.REConc):
+        res += n.res  # The empty string contributes nothing
+      else:
+        res.append(n)
+    if not res:
+      return self.epsilon
+    if len(res) == 1:
+      return res[0]
+    return self._intern((".",) + tuple(res), lambda: reg.REConc(*res),
+                        all(n._nullable for n in res))
+
+  def alt(self, *nodes):
+    res = set()
+    chars = set()
+    for n in nodes:
+      for r in n.res if isinstance(n, reg.REAlt) else [n]:
+        if r._chars is not None:
+          chars.update(r._chars)
+        else:
+          res.add(r)
+    if chars:
+      res.add(self.chars(chars))
+    if not res:
+      return self.empty
+    if len(res) == 1:
+      return res.pop()
+    res = sorted(res, key = lambda n: n._serial)
+    return self._intern(("|",) + tuple(res), lambda: reg.REAlt(*res),
+                        any(n._nullable for n in res))
+
+  def star(self, n):
+    if isinstance(n, reg.REStar):
+      return n
+    if n is self.empty or n is self.epsilon:
+      return self.epsilon
+    return self._intern(("*", n), lambda: reg.REStar(n), True)
+
+  def convert(self, re):
+    """
+    Turn an arbitrary RE tree into its canonical node in this table.
+    """
+    if isinstance(re, reg.REChar):
+      return self.chars(re.char)
+    elif isinstance(re, reg.REAny):
+      return self.chars(self.alphabet)
+    elif isinstance(re, reg.REClass):
+      return self.chars(re.set)
+    elif isinstance(re, reg.REGroup):
+      return self.convert(re.re)
+    elif isinstance(re, reg.REStar):
+      return self.star(self.convert(re.re))
+    elif isinstance(re, reg.REPlus):
+      r = self.convert(re.re)
+      return self.conc(r, self.star(r))
+    elif isinstance(re, reg.REOpt):
+      return self.alt(self.epsilon, self.convert(re.re))
+    elif isinstance(re, reg.REConc):
+      return self.conc(*map(self.convert, re.res))
+    elif isinstance(re, reg.REAlt):
+      return self.alt(*map(self.convert, re.res))
+    else:
+      raise ValueError("Can't derive " + str(re.__class__) + " for " + str(re))
+
+  def derive(self, n, c):
+    d = n._derivs.get(c)
+    if d is None:
+      d = n._derivs[c] = self._derive(n, c)
+    return d
+
+  def _derive(self, n, c):
+    if n._chars is not None:
+      return self.epsilon if c in n._chars else self.empty
+
+    elif isinstance(n, reg.REStar):
+      return self.conc(self.derive(n.re, c), n)
+
+    elif isinstance(n, reg.REAlt):
+      return self.alt(*[ self.derive(r, c) for r in n.res ])
+
+    elif isinstance(n, reg.REConc):
+      if not n.res:
+        return self.empty
+      head = n.res[0]
+      rest = self.conc(*n.res[1:])
+      d = self.conc(self.derive(head, c), rest)
+      if head._nullable:
+        d = self.alt(d, self.derive(rest, c))
+      return d
+
+    else:
+      raise ValueError("Not a canonical node: " + str(n))
+
+
+# Once a shared table holds this many nodes, DFAs made after that get a
+# fresh one (those made before keep the old one). Tables are kept for
+# the ALPHABETS alphabets most recently used.
+NODES = 100000
+ALPHABETS = 100
+
+_tables = bounded.LRU(ALPHABETS)
+
+def table(alphabet = None):
+  """
+  Return the shared table for the given alphabet (by default, the one
+  currently in use by the parser).
+  """
+  if alphabet is None:
+    alphabet = reg._alphabet
+  alphabet = frozenset(alphabet)
+  t = _tables.get(alphabet)
+  if t is None or len(t) >= NODES:
+    t = _tables[alphabet] = Table(alphabet)
+  return t
+
+
+class DFA(object):
+  """
+  The DFA whose states are the derivatives of an RE. States are
+  canonical nodes, and transitions are only computed when first asked
+  for.
+  """
+
+  def __init__(self, re, alphabet = None):
+    self.table = table(alphabet)
+    self.start = self.table.convert(re)
+    self.dead = self.table.empty
+
+  def step(self, state, c):
+    return self.table.derive(state, c)
+
+  def accepting(self, state):
+    return state._nullable
+
+  def states(self):
+    """
+    Explore the whole DFA, returning its (live and dead) states.
+    """
+    s = set([ self.start ])
+    more = [ self.start ]
+    while more:
+      state = more.pop()
+      for c in self.table.alphabet:
+        d = self.step(state, c)
+        if d not in s:
+          s.add(d)
+          more.append(d)
+    return s
+
+  def match(self, string):
+    state = self.start
+    for char in string:
+      state = self.step(state, char)
+      if state is self.dead:
+        return False
+    return self.accepting(state)
+
+  def signature(self, limit = None):
+    """
+    A canonical form of the minimal DFA for this RE, so that two REs
+    over the same alphabet have equal signatures exactly when they
+    accept the same language. The states are explored, merged by Moore's
+    partition refinement, and then numbered in the order a breadth-first
+    walk from the start meets them. Returns None if there turn out to be
+    more than limit states.
+    """
+    alphabet = sorted(self.table.alphabet)
+    index = { self.start: 0 }
+    order = [ self.start ]
+    trans = []
+    for state in order:
+      row = []
+      for c in alphabet:
+        d = self.step(state, c)
+        if d not in index:
+          if limit is not None and len(order) >= limit:
+            return None
+          index[d] = len(order)
+          order.append(d)
+        row.append(index[d])
+      trans.append(row)
+
+    block = [ self.accepting(s) for s in order ]
+    count = len(set(block))
+    while True:
+      ids = {}
+      block = [ ids.setdefault((block[i],) + tuple(block[d] for d in trans[i]), len(ids))
+                for i in range(len(order)) ]
+      if len(ids) == count:
+        break
+      count = len(ids)
+
+    number = { block[0]: 0 }
+    queue = [ 0 ]
+    rows = []
+    for i in queue:
+      row = []
+      for d in trans[i]:
+        if block[d] not in number:
+          number[block[d]] = len(number)
+          queue.append(d)
+        row.append(number[block[d]])
+      rows.append((self.accepting(order[i]), tuple(row)))
+    return tuple(rows)
@@ -0,0 +1,29 @@
+"""
+Cell domains.
+
+The set of characters still possible in a cell is held as an interned
+frozenset: equal domains are the same object wherever they turn up, so
+they can be compared by identity and used in dictionary keys cheaply,
+and a propagated grid holds no more domain objects than it has
+distinct domains.
+"""
+
+import bounded
+
+_domains = {}
+
+# The most domains kept interned. Past this, the table starts again;
+# domains from before then are still equal to the new ones, just not
+# identical, which costs no more than a spurious re-mark of a line.
+DOMAINS = 100000
+
+def domain(chars):
+  """
+  Return the interned domain holding the given characters.
+  """
+  d = frozenset(chars)
+  interned = _domains.get(d)
+  if interned is None:
+    bounded.room(_domains, DOMAINS)
+    interned = _domains[d] = d
+  return interned
@@ -30,6 +30,8 @@ d = 3.
                 0
 """
 
+from domain import domain
+
 class Grid(object):
   def __init__(self, d, a, b, c, initial_cell = None):
     self.dim = d
@@ -50,6 +52,7 @@ class Grid(object):
         self.update_possibles(dim, n)
 
   def clear(self, initial):
+    initial = domain(initial)
     self._cells = {}
     for i in range(self.l):
       for j in range(self.l):
@@ -67,6 +70,9 @@ class Grid(object):
       return tuple(c)
     return None
 
+  def cells(self):
+    return sorted(self._cells.keys())
+
   def line(self, dim, i):
     l = []
     for j in range(self.l):
@@ -89,6 +95,20 @@ class Grid(object):
       m *= len(j)
     self._possibles[dim][i] = m
 
+  def snapshot(self):
+    """
+    Capture the cells and line bookkeeping, to be put back by restore().
+    """
+    return (dict(self._cells),
+            [ list(m) for m in self._marked ],
+            [ list(p) for p in self._possibles ])
+
+  def restore(self, snapshot):
+    cells, marked, possibles = snapshot
+    self._cells = dict(cells)
+    self._marked = [ list(m) for m in marked ]
+    self._possibles = [ list(p) for p in possibles ]
+
   def counts(self, dim, i):
     return self._possibles[dim][i]
 
@@ -100,9 +120,10 @@ class Grid(object):
     j_start = max(0, self.dim - i - 1)
     for j in range(len(l)):
       c = self.coords(dim, i, j + j_start)
-      if l[j] != self._cells[c]:
+      d = domain(l[j])
+      if d is not self._cells[c]:
         #print "updating", c
-        self._cells[c] = l[j]
+        self._cells[c] = d
         # Mark other lines than this one.
         for dim2 in 0, 1, 2:
           if dim2 != dim:
@@ -118,7 +139,8 @@ class Grid(object):
   def __setitem__(self, (a, b, c), x):
     if a + b + c != self._coord_sum:
       raise KeyError
-    if x == self._cells[a, b, c]:
+    x = domain(x)
+    if x is self._cells[a, b, c]:
       return
     self._cells[a, b, c] = x
     self.mark(0, a)
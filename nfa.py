@@ -2,9 +2,12 @@
 An NFA library.
 """
 
+from array import array
 from collections import defaultdict
 import reg
 
+_none = frozenset()
+
 
 class State(object):
   def __init__(self, label = None, counter = None, start = False, end = False):
@@ -25,19 +28,19 @@ class State(object):
     dest.add_in(self, char)
 
   def out_labels(self):
-    return self._outs.keys()
+    return [ c for c, dests in self._outs.items() if dests ]
 
   def outs(self, c):
-    return self._outs[c]
+    return self._outs.get(c, _none)
 
   def add_in(self, source, char):
     self._ins[char].add(source)
 
   def in_labels(self):
-    return self._ins.keys()
+    return [ c for c, sources in self._ins.items() if sources ]
 
   def ins(self, c):
-    return self._ins[c]
+    return self._ins.get(c, _none)
 
   def del_epsilon(self, dest):
     self.del_out("", dest)
@@ -85,7 +88,6 @@ class NFA(object):
     self._states = None
     self.start.start = True
     self.end.end = True
-    #self.simplify()  # It's buggy at the moment
 
   def counter(self):
     """
@@ -100,77 +102,287 @@ class NFA(object):
     handy set.
     """
     if self._states is None:
-      s = set()
-      more = set([ self.start ])
-      while more:
-        s.update(more)
-        more = set()
-        for s1 in s:
-          for c in s1.out_labels():
-            for s2 in s1.outs(c):
-              if s2 not in s:
-                more.add(s2)
-      self._states = s
+      self._states = _reach([ self.start ], lambda s: s._outs)
 
     return self._states
 
   def __str__(self):
     chars = set()
-    states = {}
     for state in self.states():
-      states[state.label] = state
       chars.update(state.out_labels())
-    chars = sorted(chars)
+    return _format(sorted(self.states(), key = lambda s: s.label),
+                   sorted(chars),
+                   lambda state: state.label,
+                   lambda state, c: state.outs(c))
+
+  def compact(self):
+    """
+    Freeze this NFA into its array-backed form.
+    """
+    return CompactNFA(self)
+
+  def simplify(self):
+    """
+    Optimise this NFA in place without changing its language:
+      - epsilon transitions are removed, except those into the end
+        state, so that there's still a single accepting state;
+      - states unreachable from the start, or from which the end
+        can't be reached, are pruned;
+      - states that are forward- or backward-bisimilar are merged.
+    Returns the NFA, for convenience.
+    """
+    self._remove_epsilons()
+    self._prune()
+    while self._merge(lambda s: s._outs, lambda s: s.end) | \
+          self._merge(lambda s: s._ins, lambda s: s.start):
+      pass
+    return self
+
+  def _remove_epsilons(self):
+    states = self.states()
+    adds = []
+    for s1 in states:
+      for s2 in _reach([ s1 ], lambda s: { "": s._outs.get("", _none) }):
+        for char in s2.out_labels():
+          if char != "":
+            for s3 in s2.outs(char):
+              adds.append((s1, char, s3))
+        if s2.end and s2 is not s1:
+          adds.append((s1, "", s2))
+
+    for s1 in states:
+      for s2 in list(s1.outs("")):
+        s1.del_epsilon(s2)
+    for s1, char, s2 in adds:
+      s1.add_out(char, s2)
+    self._states = None
 
-    line = 'State |'
+  def _prune(self):
+    keep = self.states().intersection(_reach([ self.end ], lambda s: s._ins))
+    keep.update([ self.start, self.end ])
+    for s1 in self.states():
+      for char in s1.out_labels():
+        for s2 in list(s1.outs(char)):
+          if s1 not in keep or s2 not in keep:
+            s1.del_out(char, s2)
+      # Also cut loose anything that only leads here.
+      for char in s1.in_labels():
+        for s0 in list(s1.ins(char)):
+          if s0 not in keep:
+            s0.del_out(char, s1)
+    self._states = None
+
+  def _merge(self, edges, flag):
+    """
+    Merge the states of this NFA that are bisimilar, following the
+    given edges (outgoing for forward, incoming for backward) and
+    starting from a partition by the given flag (accepting for forward,
+    initial for backward). Each merged state takes the union of its
+    members' transitions, and the start and end states are kept as
+    their blocks' representatives.
+    Returns True if any states were merged.
+    """
+    states = self.states()
+    block = dict((s, flag(s)) for s in states)
+    count = len(set(block.values()))
+    while True:
+      sigs = dict((s, (block[s], frozenset((c, block[d])
+                                           for c, ds in edges(s).items()
+                                           for d in ds)))
+                  for s in states)
+      ids = {}
+      block = dict((s, ids.setdefault(sigs[s], len(ids))) for s in states)
+      if len(ids) == count:
+        break
+      count = len(ids)
+
+    if count == len(states):
+      return False
+
+    rep = {}
+    for s in sorted(states, key = lambda s: (not s.start, not s.end, s.label)):
+      rep.setdefault(block[s], s)
+    trans = set()
+    for s1 in states:
+      for char in s1.out_labels():
+        for s2 in s1.outs(char):
+          trans.add((rep[block[s1]], char, rep[block[s2]]))
+    for s in states:
+      s._outs = defaultdict(set)
+      s._ins = defaultdict(set)
+    for s1, char, s2 in trans:
+      s1.add_out(char, s2)
+    self._states = None
+    return True
+
+
+def _reach(states, edges):
+  """
+  All states reachable from those given, following the given edges.
+  """
+  res = set(states)
+  more = list(states)
+  while more:
+    s1 = more.pop()
+    for ds in edges(s1).values():
+      for s2 in ds:
+        if s2 not in res:
+          res.add(s2)
+          more.append(s2)
+  return res
+
+def _format(states, chars, label, outs):
+  line = 'State |'
+  count = 0
+  for c in chars:
+    line += ' ' + (c if c else 'e') + ' '
+    count = (count + 1) % 3
+    if count == 0:
+      line += '|'
+  lines = [ line ]
+  lines.append('-' * len(line))
+
+  for state in states:
+    line = ' %4d |' % label(state)
     count = 0
     for c in chars:
-      line += ' ' + (c if c else 'e') + ' '
+      dests = sorted(map(label, outs(state, c)))
+      if dests:
+        line += ' %1s ' % ','.join(map(str, dests))
+      else:
+        line += ' - '
       count = (count + 1) % 3
       if count == 0:
         line += '|'
-    lines = [ line ]
-    lines.append('-' * len(line))
-
-    for n in sorted(states.keys()):
-      state = states[n]
-      line = ' %4d |' % n
-      count = 0
-      for c in chars:
-        outs = sorted(map(lambda s: s.label, state.outs(c)))
-        if outs:
-          line += ' %1s ' % ','.join(map(str, outs))
-        else:
-          line += ' - '
-        count = (count + 1) % 3
-        if count == 0:
-          line += '|'
-      lines.append(line)
-
-    return '\n'.join(lines)
+    lines.append(line)
 
-  def simplify(self):
-    change = None
-    while change != self.states():
-      change = self.states()
-
-      #print "Simplifying: number of states before =", len(change)
-      #print self
-      #print
-
-      for s1 in self.states():
-        for s2 in list(s1.outs("")):
-          if s2.end or s1 is s2:
-            #print "Skipping e-transition to end"
-            continue
-          # Remove the transition s1->s2
-          self._states = None
-          s1.del_epsilon(s2)
-          # Clone all s2->s3 transitions to s1->s3
-          for char in s2.out_labels():
-            for s3 in s2.outs(char):
-              #print "  Cloning", s2.label, "-(", char, ")->", s3.label, "to", s1.label
-              s1.add_out(char, s3)
+  return '\n'.join(lines)
+
+
+class CompactNFA(object):
+  """
+  An immutable, array-backed NFA, produced from an NFA once construction
+  is over and used for all of the analysis.
+
+  States are numbered 0..size-1 and each character is given a small id,
+  with the empty string (epsilon) always 0. Edges are held CSR-style in
+  each direction: the destinations of state s on character id c are
+  dests[index[s * width + c]:index[s * width + c + 1]].
+
+  advance() and retreat() give the epsilon-closed successors (or
+  predecessors) of a state on a character; they are memoised as they
+  are asked for.
+  """
+
+  __slots__ = ('size', 'start', 'end', 'chars', 'labels', '_ids', '_width',
+               '_outs', '_ins', '_closures', '_steps')
+
+  def __init__(self, fa):
+    states = sorted(fa.states(), key = lambda s: s.label)
+    number = dict((s, i) for i, s in enumerate(states))
+    chars = set()
+    for state in states:
+      chars.update(state.out_labels())
+    chars.discard('')
+
+    self.size = len(states)
+    self.start = number[fa.start]
+    self.end = number[fa.end]
+    self.chars = ('',) + tuple(sorted(chars))
+    self.labels = tuple(s.label for s in states)
+    self._ids = dict((c, i) for i, c in enumerate(self.chars))
+    self._width = len(self.chars)
+    self._outs = _csr(states, number, self._ids, State.out_labels, State.outs)
+    self._ins = _csr(states, number, self._ids, State.in_labels, State.ins)
+    self._closures = ([ None ] * self.size, [ None ] * self.size)
+    self._steps = ({}, {})
+
+  def states(self):
+    return xrange(self.size)
+
+  def outs(self, s, c):
+    return self._edges(self._outs, s, c)
+
+  def ins(self, s, c):
+    return self._edges(self._ins, s, c)
+
+  def _edges(self, edges, s, c):
+    i = self._ids.get(c)
+    if i is None:
+      return ()
+    index, dests = edges
+    i += s * self._width
+    return dests[index[i]:index[i + 1]]
+
+  def epsilon_closure(self, states):
+    return self._closure(states, 0)
+
+  def epsilon_closure_reverse(self, states):
+    return self._closure(states, 1)
+
+  def advance(self, s, c):
+    return self._step(s, c, 0)
+
+  def retreat(self, s, c):
+    return self._step(s, c, 1)
+
+  def _closure(self, states, direction):
+    closures = self._closures[direction]
+    res = set()
+    for s in states:
+      closed = closures[s]
+      if closed is None:
+        edges = (self._outs, self._ins)[direction]
+        closed = set()
+        more = [ s ]
+        while more:
+          s2 = more.pop()
+          if s2 not in closed:
+            closed.add(s2)
+            more.extend(self._edges(edges, s2, ''))
+        closed = closures[s] = frozenset(closed)
+      res.update(closed)
+    return frozenset(res)
+
+  def _step(self, s, c, direction):
+    steps = self._steps[direction]
+    key = (s, c)
+    res = steps.get(key)
+    if res is None:
+      edges = (self._outs, self._ins)[direction]
+      res = steps[key] = self._closure(self._edges(edges, s, c), direction)
+    return res
+
+  def __str__(self):
+    return _format(self.states(),
+                   [ c for c in self.chars
+                       if any(self.outs(s, c) for s in self.states()) ],
+                   lambda s: self.labels[s],
+                   self.outs)
+
+
+def _csr(states, number, ids, labels, edges):
+  """
+  Lay out the edges of the states (given in number order) in CSR form,
+  visiting only the characters each state actually has edges on. (A
+  character no state has an out edge on can only label edges from
+  states that aren't there.)
+  """
+  width = len(ids)
+  counts = [ 0 ] * (len(states) * width)
+  dests = array('i')
+  for state in states:
+    base = number[state] * width
+    for i, c in sorted((ids[c], c) for c in labels(state) if c in ids):
+      ds = sorted(number[d] for d in edges(state, c) if d in number)
+      counts[base + i] = len(ds)
+      dests.extend(ds)
+  index = array('i', [ 0 ]) * (len(counts) + 1)
+  total = 0
+  for k, n in enumerate(counts):
+    total += n
+    index[k + 1] = total
+  return index, dests
 
 
 def nfa(re, state):
@@ -196,13 +408,13 @@ def nfa(re, state):
     return start, end
 
   elif isinstance(re, reg.REStar):
-    start, end = nfa(re.re, state)
+    start, end = _isolate(nfa(re.re, state), state)
     start.add_epsilon(end)
     end.add_epsilon(start)
     return start, end
 
   elif isinstance(re, reg.REOpt):
-    start, end = nfa(re.re, state)
+    start, end = _isolate(nfa(re.re, state), state)
     start.add_epsilon(end)
     return start, end
 
@@ -224,10 +436,27 @@ def nfa(re, state):
     return start, end
 
   elif isinstance(re, reg.REPlus):
-    start, end = nfa(re.re, state)
+    start, end = _isolate(nfa(re.re, state), state)
     end.add_epsilon(start)
     return start, end
 
   else:
     raise ValueError("Can't nfa-create " + str(re.__class__) + " for " + str(re))
 
+
+
+def _isolate((start, end), state):
+  """
+  Star, plus and option add epsilons between the start and end of the
+  automaton they apply to. That's only safe if nothing else enters the
+  start or leaves the end - otherwise (as with {C+A}?, whose start is
+  also where C+ loops back to) the new edges make shortcuts through the
+  rest of it - so in that case, put fresh states around it first.
+  """
+  if not start.in_labels() and not end.out_labels():
+    return start, end
+  outer_start = state()
+  outer_end = state()
+  outer_start.add_epsilon(start)
+  end.add_epsilon(outer_end)
+  return outer_start, outer_end
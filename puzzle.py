@@ -0,0 +1,71 @@
+"""
+Build a grid from the expressions of a puzzle.
+
+The expressions come as three sets, a, b and c, of 2d - 1 each, where
+d is the length of a single side of the hexagon; see grid.py for the
+layout.
+"""
+
+import itertools
+import analyse
+import reg
+import grid
+
+
+def side(res):
+  """
+  The length of a single side of the hexagon for these expressions.
+  """
+  if len(res) % 6 != 3:
+    raise ValueError("A puzzle needs three sets of 2d - 1 expressions, not " + str(len(res)))
+  return (len(res) / 3 + 1) / 2
+
+
+def expand(res, alpha):
+  """
+  Replace the expressions we can't handle by equivalents that we can.
+  """
+  res = list(res)
+  # HACK: special-case (...?)\1*
+  for i in range(len(res)):
+    if res[i] == '(...?)\\1*':
+      s = [ ''.join(j) for j in itertools.product(alpha, alpha) ]
+      s += [ ''.join(j) for j in itertools.product(alpha, alpha, alpha) ]
+      res[i] = '(' + ')+|('.join(s) + ')+'
+  return res
+
+
+def build(res, alpha = None, dim = None, derivatives = False):
+  """
+  Return the grid for a puzzle, with every cell open. The alphabet
+  defaults to the one the expressions mention, and the side to the one
+  that takes as many expressions as there are; the alphabet is made
+  current for the parser. With derivatives, the lines are constrained
+  by DFAs of derivatives rather than by NFAs (see analyse.pattern).
+  """
+  if alpha is None:
+    alpha = analyse.alphabet(res)
+  reg._alphabet = alpha
+  l = side(res) if dim is None else dim
+  if l < 1:
+    raise ValueError("A puzzle's sides can't have a length of " + str(l))
+  ll = 2 * l - 1
+  if len(res) != 3 * ll:
+    raise ValueError("A puzzle with sides of %d needs %d expressions, not %d" %
+                     (l, 3 * ll, len(res)))
+  res = expand(res, alpha)
+  # Our coordinates work such that a + b + c = 3 * (l - 1)
+  pats = [ analyse.pattern(s, derivatives) for s in res ]
+  a = pats[0:ll]
+  b = pats[ll:2*ll]
+  c = pats[ll*2:3*ll]
+  return grid.Grid(l, a, b, c, alpha)
+
+
+def make(p, derivatives = False):
+  """
+  Return the grid for a puzzle read from a corpus (see reader.puzzles).
+  """
+  if p.shape != "hexagon":
+    raise ValueError("Can't make a grid of shape " + p.shape)
+  return build(p.regexps, p.alphabet, p.dim, derivatives)
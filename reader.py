@@ -1,13 +1,102 @@
 #!/usr/bin/python
+"""
+Read puzzles from a corpus file.
 
-def read_from(fn = "regexps"):
+A corpus holds any number of puzzles. Each starts with a header line
+
+  @puzzle name
+
+and may be followed by more headers giving its metadata:
+
+  @shape hexagon        (the only shape there is, so far)
+  @dim 7                the length of a single side
+  @alphabet ABC...      the characters the cells may hold
+
+and then by its expressions, one per line: the a lines, then b, then
+c. Blank lines and lines starting with # are ignored. Metadata that
+isn't given is worked out from the expressions when the grid is built.
+A file with no headers at all, like regexps, is a corpus of a single
+puzzle.
+"""
+
+import mmap
+import os
+
+
+class Puzzle(object):
+  """
+  A puzzle from a corpus: its name, its expressions, and its metadata,
+  where None means it's to be worked out. All of its headers are also
+  kept, as strings, in meta.
+  """
 
-  res = []
-  with open(fn) as f:
-    for line in f:
-      res += process(line)
+  def __init__(self, name = None):
+    self.name = name
+    self.shape = "hexagon"
+    self.dim = None
+    self.alphabet = None
+    self.regexps = []
+    self.meta = {}
 
-  return res
+  def header(self, key, value):
+    if self.regexps:
+      raise ValueError("Header @" + key + " comes after the expressions of puzzle " + str(self.name))
+    self.meta[key] = value
+    if key == "shape":
+      self.shape = value
+    elif key == "dim":
+      self.dim = int(value)
+    elif key == "alphabet":
+      self.alphabet = set(value)
+
+  def __str__(self):
+    return "%s (%s, dim %s, %d expressions)" % (self.name or "unnamed", self.shape,
+                                                 self.dim or "?", len(self.regexps))
+
+
+def puzzles(fn = "regexps"):
+  """
+  Yield the puzzles in a corpus one at a time, as they're read. The
+  file is memory-mapped rather than read in, so only the puzzle being
+  yielded is ever held.
+  """
+  with open(fn, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return  # There's nothing to map
+    m = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+      p = None
+      for line in iter(m.readline, ""):
+        line = line.strip()
+        if line.startswith("@"):
+          key, _, value = line[1:].partition(" ")
+          if key == "puzzle":
+            if p is not None:
+              yield p
+            p = Puzzle(value.strip())
+          else:
+            if p is None:
+              p = Puzzle()
+            p.header(key, value.strip())
+        else:
+          res = process(line)
+          if res:
+            if p is None:
+              p = Puzzle()
+            p.regexps += res
+      if p is not None:
+        yield p
+    finally:
+      m.close()
+
+
+def read_from(fn = "regexps"):
+  """
+  The expressions of the first puzzle in a corpus.
+  """
+  for p in puzzles(fn):
+    return p.regexps
+  return []
 
 
 def process(line):
@@ -16,4 +105,3 @@ def process(line):
     return []
 
   return [line]
-
@@ -2,6 +2,8 @@
 A regular expression representation.
 """
 
+import bounded
+
 _alphabet = None
 
 class RE(object):
@@ -154,6 +156,174 @@ class REAlt(RE):
     return "|".join( self.bracket(re) for re in self.res )
 
 
+# Normalisation.
+#
+# normalise() rebuilds an RE bottom-up through a table of interned nodes,
+# so that structurally equal sub-expressions are the same object. On the
+# way, alternations are flattened, deduplicated and sorted, alternatives
+# that are single characters are merged into one class, and branches
+# with a common first (or last) element are factored into a trie:
+#   AB|AC|D|E   =>   A[BC]|[DE]
+#   ACE|XCE     =>   [AX]CE
+#   A|AB        =>   AB?
+
+_interned = {}
+
+# The most nodes kept interned.
+INTERNED = 100000
+
+def _intern(key, make):
+  node = _interned.get(key)
+  if node is None:
+    node = _interned[key] = make()
+  return node
+
+def _charset(re):
+  """
+  The set of characters matched by a single-character RE, or None.
+  """
+  if isinstance(re, REChar):
+    return set(re.char)
+  elif isinstance(re, REAny):
+    return set(_alphabet)
+  elif isinstance(re, REClass):
+    return re.set
+  return None
+
+def _chars(cs):
+  cs = frozenset(cs)
+  whole = cs == _alphabet
+  def make():
+    if len(cs) == 1:
+      return REChar(next(iter(cs)))
+    if whole:
+      return REAny()
+    return REClass(cs)
+  return _intern(("[]", cs, whole), make)
+
+def _unstar(re):
+  # R** = R*; R+* = R*; R?* = R*
+  while isinstance(re, (REStar, REPlus, REOpt)):
+    re = re.re
+  return re
+
+def _star(re):
+  re = _unstar(re)
+  # {R*|S}* = {R|S}*
+  if isinstance(re, REAlt) and any(r is not _unstar(r) for r in re.res):
+    re = _unstar(_alt([ _unstar(r) for r in re.res ]))
+  return _intern(("*", re), lambda: REStar(re))
+
+def _opt(re):
+  # R*? = R*; R?? = R?; R+? = R*
+  if isinstance(re, (REStar, REOpt)):
+    return re
+  elif isinstance(re, REPlus):
+    return _star(re.re)
+  return _intern(("?", re), lambda: REOpt(re))
+
+def _plus(re):
+  # R*+ = R*; R?+ = R*; R++ = R+
+  if isinstance(re, (REStar, REPlus)):
+    return re
+  elif isinstance(re, REOpt):
+    return _star(re.re)
+  return _intern(("+", re), lambda: REPlus(re))
+
+def _seq(re):
+  return re.res if isinstance(re, REConc) else [re]
+
+def _conc(res):
+  r = []
+  for re in res:
+    r += _seq(re)
+  if len(r) == 1:
+    return r[0]
+  return _intern((".",) + tuple(r), lambda: REConc(*r))
+
+def _alt(res):
+  branches = []
+  seen = set()
+  chars = set()
+  for re in res:
+    for r in re.res if isinstance(re, REAlt) else [re]:
+      cs = _charset(r)
+      if cs is not None:
+        chars.update(cs)
+      elif r not in seen:
+        seen.add(r)
+        branches.append(r)
+  if chars:
+    branches.append(_chars(chars))
+
+  branches = _factor(branches, 0)
+  branches = _factor(branches, -1)
+
+  if len(branches) == 1:
+    return branches[0]
+  branches.sort(key = str)
+  return _intern(("|",) + tuple(branches), lambda: REAlt(*branches))
+
+def _factor(branches, end):
+  """
+  Merge the branches of an alternation that share their first (end = 0)
+  or last (end = -1) element.
+  """
+  order = []
+  groups = {}
+  for re in branches:
+    key = _seq(re)[end]
+    if key not in groups:
+      order.append(key)
+      groups[key] = []
+    groups[key].append(re)
+
+  res = []
+  for key in order:
+    group = groups[key]
+    if len(group) == 1:
+      res += group
+      continue
+    if end == 0:
+      rests = [ _seq(re)[1:] for re in group ]
+      res.append(_conc([ key, _rest(rests) ]))
+    else:
+      rests = [ _seq(re)[:-1] for re in group ]
+      res.append(_conc([ _rest(rests), key ]))
+  return res
+
+def _rest(rests):
+  alt = _alt([ _conc(r) for r in rests if r ])
+  if [] in rests:
+    return _opt(alt)
+  return alt
+
+def normalise(re):
+  """
+  Return a hash-consed, normalised RE equivalent to the one given.
+  """
+  bounded.room(_interned, INTERNED)  # Only ever between normalisations
+  return _normalise(re)
+
+def _normalise(re):
+  if isinstance(re, (REChar, REAny, REClass)):
+    return _chars(_charset(re))
+  elif isinstance(re, REGroup):
+    return _normalise(re.re)
+  elif isinstance(re, REStar):
+    return _star(_normalise(re.re))
+  elif isinstance(re, REOpt):
+    return _opt(_normalise(re.re))
+  elif isinstance(re, REPlus):
+    return _plus(_normalise(re.re))
+  elif isinstance(re, REConc):
+    return _conc(map(_normalise, re.res))
+  elif isinstance(re, REAlt):
+    return _alt(map(_normalise, re.res))
+  else:
+    raise ValueError("Can't normalise " + str(re.__class__) + " for " + str(re))
+
+
 # Regular expression parsing.
 
 class Tokeniser(object):
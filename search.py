@@ -0,0 +1,174 @@
+"""
+Search for complete solutions of a grid.
+
+Propagation squeezes each marked line of the grid until none is left
+marked; that narrows the cells as far as the lines allow one at a time.
+Pairwise consistency goes further, by looking at crossing lines
+together. Search picks an undecided cell, tries each of its characters
+in turn and propagates again. Each branch starts from its parent's
+propagated cells, and the patterns' wash traces carry over from one
+branch to the next, so little is recomputed.
+"""
+
+import analyse
+
+
+def lines(g):
+  return [ (dim, i) for dim in 0, 1, 2 for i in range(g.l) ]
+
+
+# Lines whose automata are only approximations are exhausted against
+# the real expression once that is expected to take no more than this
+# many seconds, at the throughput measured so far; each is given
+# twice that before it stops with what it has proved.
+EXHAUST = 0.1
+
+def propagate(g, progress = None):
+  """
+  Squeeze every marked line of g until none is marked.
+  Raises analyse.Impossible if some line can't be satisfied.
+  If progress is given, it's called as progress(dim, i, before, after)
+  each time a line's count of possibilities goes down.
+  """
+  while True:
+    marked = [ (dim, i) for dim, i in lines(g) if g.marked(dim, i) ]
+    if not marked:
+      return
+    for dim, i in marked:
+      if progress:
+        before = [ g.counts(*line) for line in lines(g) ]
+      pat = g.constraint(dim, i)
+      g.line_update(dim, i, pat.squeeze(g.line(dim, i)))
+      if not pat.exact and g.counts(dim, i) <= analyse.throughput.candidates(EXHAUST):
+        line = pat.exhaust(g.line(dim, i), analyse.Budget(seconds = 2 * EXHAUST))
+        if not all(line):
+          raise analyse.Impossible("exhaust has run out of possibilities", dim, i)
+        g.line_update(dim, i, line)
+      if progress:
+        for line, count in zip(lines(g), before):
+          if g.counts(*line) < count:
+            progress(line[0], line[1], count, g.counts(*line))
+
+
+def pairwise(g):
+  """
+  Pairwise consistency between crossing lines. For each pair of lines
+  meeting at a cell, try each character left in that cell: fix the cell
+  to it, squeeze both lines, then wash every other line crossing a cell
+  that either of them narrowed. A character for which any of that fails
+  lacks joint support from the pair, and is removed.
+  Returns the number of characters removed; raises analyse.Impossible
+  if a cell is left with none.
+  """
+  removed = 0
+  for cell in g.cells():
+    for pair in (0, 1), (0, 2), (1, 2):
+      if len(g[cell]) < 2:
+        break
+      supported = set(c for c in g[cell] if _supported(g, cell, pair, c))
+      if not supported:
+        raise analyse.Impossible("pairwise has run out of possibilities", cell, pair)
+      if len(supported) != len(g[cell]):
+        removed += len(g[cell]) - len(supported)
+        g[cell] = supported
+  return removed
+
+def _supported(g, cell, pair, char):
+  saved = g.snapshot()
+  try:
+    g[cell] = set([ char ])
+    for dim in pair:
+      i = cell[dim]
+      g.line_update(dim, i, g.constraint(dim, i).squeeze(g.line(dim, i)))
+    squeezed = set((dim, cell[dim]) for dim in pair)
+    for dim, i in lines(g):
+      if g.marked(dim, i) and (dim, i) not in squeezed:
+        g.constraint(dim, i).wash(g.line(dim, i))
+    return True
+  except analyse.Impossible:
+    return False
+  finally:
+    g.restore(saved)
+
+
+def consistent(g):
+  """
+  Check a fully-decided grid against the original expressions (which,
+  with back-references, may be stricter than their automata).
+  """
+  for dim, i in lines(g):
+    string = "".join(next(iter(cell)) for cell in g.line(dim, i))
+    if not g.constraint(dim, i).accepts(string):
+      return False
+  return True
+
+
+def solutions(g, limit = None, pairs = False, check = None):
+  """
+  Generate the solutions of g, each as a dict from cell coordinates to
+  characters, stopping after limit of them if that's given. With pairs,
+  each branch is also made pairwise consistent before splitting. If
+  check is given, it's called at every branch of the search, and may
+  raise an exception to abandon it. While a solution is being yielded,
+  g itself holds it; once the generator is finished with (or closed),
+  g is put back as it was found.
+  """
+  if limit is not None and limit <= 0:
+    return
+  saved = g.snapshot()
+  found = 0
+  try:
+    for solution in _search(g, pairs, check):
+      yield solution
+      found += 1
+      if found == limit:
+        return
+  finally:
+    g.restore(saved)
+
+
+def _search(g, pairs, check):
+  if check:
+    check()
+  try:
+    propagate(g)
+    while pairs and pairwise(g):
+      propagate(g)
+  except analyse.Impossible:
+    return
+
+  # Branch first on the lines whose automata are only approximations,
+  # so that they come within reach of exhaust as soon as possible.
+  loose = set((dim, i) for dim, i in lines(g)
+              if not g.constraint(dim, i).exact and g.counts(dim, i) > 1)
+  undecided = [ (not any((dim, c[dim]) in loose for dim in (0, 1, 2)), len(g[c]), c)
+                for c in g.cells() if len(g[c]) != 1 ]
+  if not undecided:
+    if consistent(g):
+      yield dict((c, next(iter(g[c]))) for c in g.cells())
+    return
+
+  _, n, cell = min(undecided)
+  if n == 0:
+    return
+  saved = g.snapshot()
+  for char in sorted(g[cell]):
+    g[cell] = set([ char ])
+    for solution in _search(g, pairs, check):
+      yield solution
+    g.restore(saved)
+
+
+def count(g, limit = None, pairs = False):
+  """
+  Count the solutions of g, up to limit.
+  """
+  return sum(1 for s in solutions(g, limit, pairs))
+
+
+def unique(g, pairs = False):
+  """
+  Does g have exactly one solution? Only looks far enough to find a
+  second.
+  """
+  return count(g, 2, pairs) == 1
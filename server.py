@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+A long-running solver, listening on a Unix socket.
+
+A client sends requests, one JSON object per line, and gets back a
+stream of events for each, also one JSON object per line. A request
+holds:
+
+  regexps    the puzzle's expressions, the a lines, then b, then c
+  alphabet   (optional) the characters to use; by default, those the
+             expressions mention
+  dim        (optional) the length of a side; by default, worked out
+             from the number of expressions
+  cells      (optional) a partial grid, as a list of [a, b, c, chars]
+  solutions  (optional) how many solutions to look for, or null for
+             all of them; by default, the grid is only propagated
+  pairs      (optional) make the grid pairwise consistent as well
+  derivatives  (optional) constrain the lines with DFAs of derivatives
+             rather than with NFAs
+
+The events are:
+
+  line       a line's count of possibilities went down, with
+             "line": [dim, i], "before" and "after"
+  grid       the propagated grid, with "cells" and "text"
+  solution   a solution, with "cells"
+  done       the last event, with the number of "solutions" found,
+             whether the puzzle was "impossible", and the "seconds" taken
+  error      the last event, if the request failed, with a "message"
+
+The work is done by a pool of worker processes. Each keeps the
+patterns it has compiled from one request to the next, so a puzzle it
+has seen before - or that shares expressions with one it has - only
+costs the search itself. Events come back from the workers on a
+managed queue, one per request. If the client goes away, the request
+is cancelled: the worker gives up at its next event or search branch.
+"""
+
+import json
+import multiprocessing
+import os
+import Queue
+import select
+import socket
+import SocketServer
+import stat
+import sys
+import time
+
+import analyse
+import puzzle
+import reader
+import search
+
+SOCKET = "regexword.sock"
+
+# The events that end the stream for a request.
+FINAL = ("done", "error")
+
+# How often, in seconds, a search looks to see if it's been cancelled.
+CHECK = 0.1
+
+
+class Cancelled(Exception):
+  pass
+
+
+def _cells(g):
+  return [ [ a, b, c, "".join(sorted(g[a, b, c])) ] for a, b, c in g.cells() ]
+
+def work(request, events, cancel = None):
+  """
+  Carry out one request, putting its events on the queue, until the
+  cancel event (if any) is set.
+  """
+  checked = [ time.time() ]
+
+  def check():
+    if cancel is not None and cancel.is_set():
+      raise Cancelled()
+
+  def pace():
+    now = time.time()
+    if now - checked[0] >= CHECK:
+      checked[0] = now
+      check()
+
+  def send(event, **fields):
+    check()
+    fields["event"] = event
+    events.put(fields)
+
+  def progress(dim, i, before, after):
+    send("line", line = [ dim, i ], before = before, after = after)
+
+  start = time.time()
+  try:
+    alpha = request.get("alphabet")
+    g = puzzle.build(map(str, request["regexps"]), set(str(alpha)) if alpha else None,
+                     request.get("dim"), request.get("derivatives", False))
+    for a, b, c, chars in request.get("cells", []):
+      g[a, b, c] = set(str(chars))
+    pairs = request.get("pairs", False)
+    limit = request.get("solutions", 0)
+    found = 0
+    try:
+      search.propagate(g, progress)
+      while pairs and search.pairwise(g):
+        search.propagate(g, progress)
+      send("grid", cells = _cells(g), text = str(g))
+      if limit != 0:
+        for s in search.solutions(g, limit, pairs, pace):
+          found += 1
+          send("solution", cells = [ [ a, b, c, s[a, b, c] ] for a, b, c in sorted(s) ])
+      impossible = False
+    except analyse.Impossible:
+      impossible = True
+    send("done", solutions = found, impossible = impossible, seconds = time.time() - start)
+  except Cancelled:
+    pass
+  except Exception as e:
+    send("error", message = str(e))
+
+
+class Handler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    try:
+      self.serve()
+    except socket.error:
+      pass  # The client has gone away
+
+  def finish(self):
+    try:
+      SocketServer.StreamRequestHandler.finish(self)
+    except socket.error:
+      pass  # Whatever was left to send can't be
+
+  def serve(self):
+    for line in iter(self.rfile.readline, ""):
+      if not line.strip():
+        continue
+      try:
+        request = json.loads(line)
+      except ValueError as e:
+        if not self.send({ "event": "error", "message": str(e) }):
+          return
+        continue
+
+      events = self.server.manager.Queue()
+      cancel = self.server.manager.Event()
+      result = self.server.pool.apply_async(work, (request, events, cancel))
+      try:
+        while True:
+          try:
+            event = events.get(timeout = 1)
+          except Queue.Empty:
+            if self.gone():
+              return
+            if not result.ready() or not events.empty():
+              continue
+            event = { "event": "error", "message": "the worker gave up" }
+          if not self.send(event):
+            return
+          if event["event"] in FINAL:
+            break
+      finally:
+        cancel.set()  # If the worker's still going, it needn't be
+
+  def gone(self):
+    """
+    Has the client hung up? (It may have sent its next request already,
+    which is fine.)
+    """
+    readable, _, _ = select.select([ self.connection ], [], [], 0)
+    return bool(readable) and self.connection.recv(1, socket.MSG_PEEK) == ""
+
+  def send(self, event):
+    """
+    Send an event to the client, returning False if it's gone away.
+    """
+    try:
+      self.wfile.write(json.dumps(event) + "\n")
+      self.wfile.flush()
+      return True
+    except socket.error:
+      return False
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """
+  Serve requests on the socket at path, with a pool of the given
+  number of worker processes (by default, one per CPU).
+  """
+
+  daemon_threads = True
+
+  def __init__(self, path = SOCKET, processes = None):
+    # Start the workers before there's a socket for them to inherit.
+    self.pool = multiprocessing.Pool(processes)
+    self.manager = multiprocessing.Manager()
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+      os.unlink(path)  # Left behind by an earlier server
+    SocketServer.UnixStreamServer.__init__(self, path, Handler)
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    os.unlink(self.server_address)
+    self.pool.terminate()
+    self.manager.shutdown()
+
+
+def ask(request, path = SOCKET):
+  """
+  Send a request to the server at path, yielding the events that come
+  back.
+  """
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  s.connect(path)
+  try:
+    s.sendall(json.dumps(request) + "\n")
+    f = s.makefile()
+    for line in iter(f.readline, ""):
+      event = json.loads(line)
+      yield event
+      if event["event"] in FINAL:
+        return
+  finally:
+    s.close()
+
+
+if __name__ == "__main__":
+  if len(sys.argv) > 1 and sys.argv[1] == "ask":
+    # ask [n] [corpus]: solve each puzzle in the corpus, looking for n
+    # solutions to each
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    for p in reader.puzzles(*sys.argv[3:4]):
+      print p
+      request = { "regexps": p.regexps, "dim": p.dim, "solutions": limit }
+      if p.alphabet:
+        request["alphabet"] = "".join(sorted(p.alphabet))
+      for event in ask(request):
+        if event["event"] in ("grid", "error"):
+          print event.get("text", event.get("message"))
+        else:
+          print json.dumps(event)
+  else:
+    server = Server(*sys.argv[1:2])
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()